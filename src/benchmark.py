@@ -0,0 +1,43 @@
+"""
+Measures the throughput cost of clipboard payload encryption
+"""
+
+import os
+import time
+from payload_cipher import PayloadCipher
+
+SIZES = {
+    'text (4 KiB)': 4 * 1024,
+    'image (1 MiB)': 1024 * 1024,
+    'image (16 MiB)': 16 * 1024 * 1024
+}
+MIN_DURATION = 0.5
+
+
+def measure(function, data):
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        function(data)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_DURATION:
+            return runs * len(data) / elapsed / (1024 * 1024)
+
+
+def run_benchmark():
+    cipher = PayloadCipher(os.urandom(32))
+    print(f"{'Payload':<16}{'Copy MB/s':>12}{'Encrypt MB/s':>15}{'Decrypt MB/s':>15}{'Overhead':>10}")
+    for name, size in SIZES.items():
+        data = os.urandom(size)
+        encrypted = cipher.encrypt(data, 'image', '')
+        copy_speed = measure(bytes, bytearray(data))
+        encrypt_speed = measure(lambda payload: sum(len(chunk) for chunk in
+                                                    cipher.encrypt_chunks(payload, 'image', '')), data)
+        decrypt_speed = measure(lambda payload: cipher.decrypt(payload, 'image', ''), encrypted)
+        overhead = len(encrypted) / len(data) - 1
+        print(f'{name:<16}{copy_speed:>12.0f}{encrypt_speed:>15.0f}{decrypt_speed:>15.0f}{overhead:>10.2%}')
+
+
+if __name__ == '__main__':
+    run_benchmark()
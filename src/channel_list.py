@@ -0,0 +1,363 @@
+"""
+Class to keep track of clipboard channels hosted by the server
+"""
+
+import os
+import time
+import queue
+import struct
+import hashlib
+import threading
+
+RECORD_MAGIC = b'CCR2'
+RECORD_HEADER = struct.Struct('>4sHHBQdQ')
+FLAG_ENCRYPTED = 1
+FLAG_REMOVED = 2
+COMPACT_MIN_SIZE = 1024 * 1024
+
+
+class ChannelList:
+    def __init__(self, history_size=10, persist_history=False, persist_plaintext=False, coalesce_delay=0.5,
+                 max_coalesce_delay=2.0):
+        """
+        Only the current encrypted item of each group is written to disk unless persist_history or
+        persist_plaintext is set. Updates less than coalesce_delay apart form a burst that lasts at most
+        max_coalesce_delay
+        """
+        self._channels = {}
+        self._content = {}
+        self.history_size = history_size
+        self.coalesce_delay = coalesce_delay
+        self.max_coalesce_delay = max_coalesce_delay
+        self.persist_history = persist_history
+        self.persist_plaintext = persist_plaintext
+        self._log_path = None
+        self._log = None
+        self._queue = None
+        self._writer = None
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _store_content(self, data):
+        content_hash = hashlib.sha256(data).hexdigest()
+        if content_hash in self._content:
+            self._content[content_hash]['refs'] += 1
+        else:
+            self._content[content_hash] = {'data': data, 'refs': 1}
+        return content_hash
+
+    def _release_content(self, content_hash):
+        if content_hash in self._content:
+            self._content[content_hash]['refs'] -= 1
+            if self._content[content_hash]['refs'] <= 0:
+                del self._content[content_hash]
+
+    def _get_channel(self, group):
+        if group not in self._channels:
+            self._channels[group] = {
+                'version': 0,
+                'hash': self._store_content(b''),
+                'data type': 'text',
+                'encrypted': False,
+                'last update': 0.0,
+                'burst start': 0.0,
+                'history': [],
+                'persisted': False,
+                'last access': time.time()
+            }
+        return self._channels[group]
+
+    def _remove(self, group):
+        channel = self._channels.pop(group)
+        self._release_content(channel['hash'])
+        for item in channel['history']:
+            self._release_content(item['hash'])
+        return channel
+
+    def _apply(self, group, data, data_type, encrypted, version, last_update):
+        channel = self._get_channel(group)
+        if last_update - channel['last update'] >= self.coalesce_delay or \
+                last_update - channel['burst start'] >= self.max_coalesce_delay:
+            channel['burst start'] = last_update
+        old_hash = channel['hash']
+        channel['hash'] = self._store_content(data)
+        self._release_content(old_hash)
+        channel['data type'] = data_type
+        channel['encrypted'] = encrypted
+        channel['version'] = version
+        channel['last update'] = last_update
+
+        # History holds its own reference to each item so older contents stay in the cache
+        channel['history'].append({
+            'hash': self._store_content(data),
+            'data type': data_type,
+            'encrypted': encrypted,
+            'version': version,
+            'last update': last_update
+        })
+        while len(channel['history']) > self.history_size:
+            self._release_content(channel['history'].pop(0)['hash'])
+
+    def _persistable(self, item):
+        return item['encrypted'] or self.persist_plaintext
+
+    def _persisted_items(self):
+        """
+        Yields (group, item) for every item that belongs in the log
+        """
+        for group, channel in self._channels.items():
+            if not self._persistable(channel):
+                continue
+            items = channel['history'] if self.persist_history else channel['history'][-1:]
+            for item in items:
+                if self._persistable(item):
+                    yield group, item
+
+    @staticmethod
+    def _encode_record(group, data, data_type, flags, version, last_update):
+        group = group.encode()
+        data_type = data_type.encode()
+        return RECORD_HEADER.pack(RECORD_MAGIC, len(group), len(data_type), flags, version, last_update,
+                                  len(data)) + group + data_type + data
+
+    def _encode_item(self, group, item, last_update=None):
+        return self._encode_record(group, self._content[item['hash']]['data'], item['data type'],
+                                   FLAG_ENCRYPTED if item['encrypted'] else 0, item['version'],
+                                   item['last update'] if last_update is None else last_update)
+
+    @staticmethod
+    def _decode_records(view):
+        """
+        Yields (offset after record, group, data, data type, flags, version, last update) until the first
+        incomplete or corrupt record
+        """
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(view):
+            magic, group_size, type_size, flags, version, last_update, data_size = \
+                RECORD_HEADER.unpack_from(view, offset)
+            end = offset + RECORD_HEADER.size + group_size + type_size + data_size
+            if magic != RECORD_MAGIC or end > len(view):
+                return
+            start = offset + RECORD_HEADER.size
+            group = bytes(view[start:start + group_size]).decode()
+            data_type = bytes(view[start + group_size:start + group_size + type_size]).decode()
+            data = bytes(view[start + group_size + type_size:end])
+            offset = end
+            yield offset, group, data, data_type, flags, version, last_update
+
+    def _enqueue(self, kind, args=None):
+        """
+        Queues a log operation for the writer thread. Must be called with the lock held so operations are
+        numbered in the same order as the changes they record
+        """
+        if self._log is not None:
+            self._sequence += 1
+            self._queue.put((self._sequence, kind, args))
+
+    def _enqueue_item(self, group, item):
+        self._enqueue('append', (group, self._content[item['hash']]['data'], item['data type'],
+                                 FLAG_ENCRYPTED if item['encrypted'] else 0, item['version'], item['last update']))
+
+    def _write_log(self):
+        """
+        Writes queued operations to the log so large payloads never hold the lock while they reach the disk
+        """
+        compacted_sequence = 0
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            sequence, kind, args = entry
+            # The compacted log already reflects every operation queued before it was written
+            if sequence <= compacted_sequence:
+                continue
+            try:
+                if kind == 'append':
+                    self._log.write(self._encode_record(*args))
+                elif kind == 'removal':
+                    self._log.write(self._encode_record(args, b'', '', FLAG_REMOVED, 0, 0.0))
+                self._log.flush()
+                if kind == 'compact' or self._needs_compaction():
+                    compacted_sequence = self._compact()
+            except OSError as e:
+                print(f"Error writing clipboard log: {e}")
+
+    def _needs_compaction(self):
+        """
+        Whether superseded records take up more space than the live ones
+        """
+        with self._lock:
+            live_size = sum(RECORD_HEADER.size + len(group.encode()) + len(item['data type'].encode()) +
+                            len(self._content[item['hash']]['data']) for group, item in self._persisted_items())
+        return self._log.tell() > max(COMPACT_MIN_SIZE, 2 * live_size)
+
+    def _compact(self):
+        with self._lock:
+            records = [(group, self._content[item['hash']]['data'], item['data type'],
+                        FLAG_ENCRYPTED if item['encrypted'] else 0, item['version'], item['last update'])
+                       for group, item in self._persisted_items()]
+            sequence = self._sequence
+        temp_path = self._log_path + '.tmp'
+        with open(temp_path, 'wb') as temp_log:
+            for record in records:
+                temp_log.write(self._encode_record(*record))
+        self._log.close()
+        os.replace(temp_path, self._log_path)
+        self._log = open(self._log_path, 'ab')
+        return sequence
+
+    def open(self, path):
+        """
+        Restores channels from the append-only log at path and appends future updates to it. Channels that are
+        already in memory, e.g. when the server restarts within the same process, are kept and written to the log
+        instead
+        """
+        self.close()
+        with self._lock:
+            self._log_path = path
+            if self._channels:
+                for channel in self._channels.values():
+                    channel['persisted'] = self._persistable(channel)
+            else:
+                self._content.clear()
+                self._replay(path)
+            self._log = open(path, 'ab')
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_log, daemon=True)
+            self._writer.start()
+            self._enqueue('compact')
+
+    def _replay(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as log:
+            contents = log.read()
+        valid_size = 0
+        for valid_size, group, data, data_type, flags, version, last_update in \
+                self._decode_records(memoryview(contents)):
+            if flags & FLAG_REMOVED:
+                if group in self._channels:
+                    self._remove(group)
+            else:
+                self._apply(group, data, data_type, bool(flags & FLAG_ENCRYPTED), version, last_update)
+                self._channels[group]['persisted'] = True
+                # Give restored groups time for their devices to reconnect before they can be evicted
+                self._channels[group]['last access'] = time.time()
+        if valid_size < len(contents):
+            # Drop a record left incomplete by an interrupted write
+            with open(path, 'r+b') as log:
+                log.truncate(valid_size)
+
+    def close(self):
+        """
+        Waits for queued writes to reach the log and closes it
+        """
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        with self._lock:
+            self._log.close()
+            self._log = None
+            self._writer = None
+
+    def compact(self):
+        with self._lock:
+            self._enqueue('compact')
+
+    def set_persistence(self, persist_history, persist_plaintext):
+        """
+        Changes what is written to disk and rewrites the log to match
+        """
+        with self._lock:
+            self.persist_history = persist_history
+            self.persist_plaintext = persist_plaintext
+            for channel in self._channels.values():
+                channel['persisted'] = self._persistable(channel)
+            self._enqueue('compact')
+
+    def get_item(self, group):
+        """
+        Returns a copy of a group's clipboard item along with its data
+        """
+        with self._lock:
+            channel = self._get_channel(group)
+            channel['last access'] = time.time()
+            return dict(channel, data=self._content[channel['hash']]['data'], history=list(channel['history']))
+
+    def set_item(self, group, data, data_type, encrypted=False):
+        with self._lock:
+            channel = self._get_channel(group)
+            version = channel['version'] + 1
+            channel['last access'] = time.time()
+            self._apply(group, data, data_type, encrypted, version, time.time())
+            if self._persistable(channel):
+                self._enqueue_item(group, channel['history'][-1])
+                channel['persisted'] = True
+            elif channel['persisted']:
+                # Keep an older persisted item from coming back as the current one after a restart
+                self._enqueue('removal', group)
+                channel['persisted'] = False
+            return version, channel['hash']
+
+    def export_state(self, group):
+        """
+        Returns the group's current item in log format so it can be handed to another server. The timestamp field
+        holds the item's age in seconds, since clocks on different hosts cannot be compared
+        """
+        with self._lock:
+            channel = self._channels.get(group)
+            if channel is None or channel['version'] == 0:
+                return b''
+            return self._encode_item(group, channel['history'][-1], time.time() - channel['last update'])
+
+    def import_state(self, state, group):
+        """
+        Applies the group's item from another server's exported state if it is newer than the local one
+        """
+        imported = 0
+        for _, record_group, data, data_type, flags, _, age in self._decode_records(memoryview(state)):
+            if record_group != group or flags & FLAG_REMOVED:
+                continue
+            with self._lock:
+                channel = self._get_channel(group)
+                local_age = time.time() - channel['last update'] if channel['version'] else float('inf')
+            if max(age, 0.0) < local_age:
+                self.set_item(group, data, data_type, bool(flags & FLAG_ENCRYPTED))
+                imported += 1
+        return imported
+
+    def evict(self, active_groups, idle_timeout):
+        """
+        Removes the channels of groups that have had no devices and no requests for idle_timeout seconds
+        """
+        with self._lock:
+            idle_groups = [group for group, channel in self._channels.items()
+                           if group not in active_groups and time.time() - channel['last access'] > idle_timeout]
+            for group in idle_groups:
+                if self._remove(group)['persisted']:
+                    self._enqueue('removal', group)
+
+    def is_settled(self, item):
+        """
+        Whether an item from get_item can be fanned out. The first item of a burst goes out at once, later ones once
+        the burst has been quiet for coalesce_delay, and a burst longer than max_coalesce_delay starts a new one
+        """
+        return item['last update'] == item['burst start'] or time.time() - item['last update'] >= self.coalesce_delay
+
+    def get_groups(self):
+        with self._lock:
+            return list(self._channels)
+
+    def clear(self):
+        with self._lock:
+            self._channels.clear()
+            self._content.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._channels),
+                'cached items': len(self._content),
+                'cached bytes': sum(len(item['data']) for item in self._content.values())
+            }
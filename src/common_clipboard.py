@@ -5,6 +5,7 @@ Main file for application
 import requests
 import time
 import win32clipboard as clipboard
+import win32crypt
 import sys
 import os
 import pickle
@@ -20,9 +21,12 @@ from enum import Enum
 from pystray import Icon, Menu, MenuItem
 from PIL import Image
 from io import BytesIO
-from server import run_server
+from urllib.parse import urlsplit
+from server import run_server, set_handoff_token, set_persistence
 from device_list import DeviceList
-from port_editor import PortEditor
+from http_clients import HttpClient
+from port_editor import PortEditor, GroupEditor, PassphraseEditor
+from payload_cipher import PayloadCipher
 import winreg
 
 
@@ -32,10 +36,13 @@ class Format(Enum):
 
 # Connection state management
 connection_lock = threading.Lock()
-# Guards and shared client
+# Guards and role-separated clients so discovery and server control traffic cannot crowd out clipboard sync
 scan_in_progress = threading.Event()
 port_dialog_open = threading.Event()
-http = requests.Session()
+SCAN_WORKERS = 16
+sync_http = HttpClient('Sync', pool_connections=1, pool_maxsize=2, timeout=5)
+probe_http = HttpClient('Discovery', pool_connections=SCAN_WORKERS, pool_maxsize=1, timeout=2)
+control_http = HttpClient('Control', pool_connections=2, pool_maxsize=1, timeout=2)
 
 # Global variables for single instance control
 instance_lock = None
@@ -53,6 +60,21 @@ def check_single_instance():
         return False
 
 
+def protect_key(key):
+    """Encrypt the group key with DPAPI so only the current Windows user can read it back"""
+    return win32crypt.CryptProtectData(key, APP_NAME, None, None, None, 0)
+
+
+def unprotect_key(protected_key):
+    if not protected_key:
+        return None
+    try:
+        return win32crypt.CryptUnprotectData(protected_key, None, None, None, 0)[1]
+    except Exception:
+        # Keys saved by another user or in an older format cannot be recovered
+        return None
+
+
 def register(address):
     global server_url
 
@@ -68,7 +90,7 @@ def register(address):
     except OSError:
         hostname = "Unknown_Device"
     
-    http.post(server_url + '/register', json={'name': hostname})
+    sync_http.post(server_url + '/register', json={'name': hostname, 'group': group})
 
 
 def test_server_ip(index):
@@ -83,13 +105,14 @@ def test_server_ip(index):
         
         # Test timestamp endpoint (original repository method)
         try:
-            response = http.get(tested_url + '/timestamp', timeout=2)
+            response = probe_http.get(tested_url + '/timestamp', timeout=2)
             if response.ok and float(response.text) < server_timestamp:
                 # If we find a suitable remote server, stop local server thread cleanly
                 try:
                     if server_thread is not None and server_thread.is_alive():
+                        hand_off_state(tested_ip)
                         try:
-                            http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
+                            control_http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
                         except Exception:
                             pass
                         server_thread.join(timeout=3)
@@ -109,14 +132,38 @@ def test_server_ip(index):
         pass
 
 
+def hand_off_state(address):
+    """
+    Give the newly elected server this host's clipboard item before the local server stops. Only the host's own
+    group is handed over, and only when it uses a passphrase, since the elected server can authenticate nothing else.
+    Items of other groups hosted here are lost on failover until one of their devices copies again
+    """
+    if cipher is None:
+        return
+    try:
+        # The elected server only accepts a handoff from a registered device of its own group
+        register(address)
+        state = control_http.get(f'http://127.0.0.1:{port}/state', params={'group': group}, timeout=2)
+        if state.ok and state.content:
+            response = control_http.post(f'http://{address}:{port}/state', data=state.content,
+                                       headers={'Handoff-Token': cipher.handoff_token()}, timeout=30)
+            if not response.ok:
+                print(f"State handoff failed: {response.status_code} {response.text}")
+    except Exception as e:
+        print(f"State handoff failed: {e}")
+
+
+def update_handoff_token():
+    set_handoff_token(group, cipher.handoff_token() if cipher is not None else None)
+
+
 def generate_ips():
     # Bounded concurrency scan to reduce Wi‑Fi/CPU pressure
     if scan_in_progress.is_set():
         return
     scan_in_progress.set()
     try:
-        max_workers = 16
-        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
             for k in range(1, 255):  # 1..254
                 if k == int(split_ipaddr[3]):
                     continue
@@ -135,7 +182,7 @@ def find_server():
     start_ts = time.time()
     while time.time() - start_ts < 2.0:
         try:
-            resp = http.get(f'http://127.0.0.1:{port}/timestamp', timeout=0.3)
+            resp = probe_http.get(f'http://127.0.0.1:{port}/timestamp', timeout=0.3)
             if resp.ok:
                 break
         except Exception:
@@ -167,6 +214,7 @@ def get_copied_data():
 def detect_local_copy():
     global current_data
     global current_format
+    global current_etag
 
     with connection_lock:
         if not server_url:
@@ -174,16 +222,29 @@ def detect_local_copy():
 
         new_data, new_format = get_copied_data()
         if new_data != current_data:
+            previous_data = current_data
             current_data = new_data
             current_format = new_format
 
             file = None
             try:
-                file = BytesIO()
-                file.write(current_data.encode() if current_format == Format.TEXT else current_data)
-                file.seek(0)
-                response = http.post(server_url + '/clipboard', data=file, headers={'Data-Type': format_to_type[current_format]}, timeout=5)
-                if not response.ok:
+                payload = current_data.encode() if current_format == Format.TEXT else current_data
+                headers = {'Data-Type': format_to_type[current_format]}
+                if cipher is not None:
+                    # Stream encrypted chunks instead of building a second full copy of the payload
+                    file = cipher.encrypt_chunks(payload, headers['Data-Type'], group)
+                    headers['Data-Encrypted'] = 'True'
+                else:
+                    file = BytesIO()
+                    file.write(payload)
+                    file.seek(0)
+                response = sync_http.post(server_url + '/clipboard', data=file, headers=headers, timeout=5)
+                if response.status_code == 429:
+                    # Rate limited by the server; retry with the latest copy on a later loop
+                    current_data = previous_data
+                elif response.ok:
+                    current_etag = response.headers.get('ETag')
+                else:
                     print(f"Failed to send clipboard data: {response.status_code}")
             except Exception as e:
                 print(f"Error sending clipboard data: {e}")
@@ -198,18 +259,34 @@ def detect_local_copy():
 def detect_server_change():
     global current_data
     global current_format
+    global current_etag
 
     with connection_lock:
         if not server_url:
             return
 
         try:
-            headers = http.head(server_url + '/clipboard', timeout=3)
-            if headers.ok and headers.headers.get('Data-Attached') == 'True':
-                data_request = http.get(server_url + '/clipboard', timeout=5)
-                if data_request.ok:
+            # Lets a restarted server skip sending data this device already holds
+            conditional_headers = {'If-None-Match': current_etag} if current_etag else {}
+            headers = sync_http.head(server_url + '/clipboard', headers=conditional_headers, timeout=3)
+            if headers.status_code == 401:
+                # The server no longer knows this device, e.g. after a restart without saved state
+                register(urlsplit(server_url).hostname)
+            elif headers.ok and headers.headers.get('Data-Attached') == 'True':
+                data_request = sync_http.get(server_url + '/clipboard', headers=conditional_headers, timeout=5)
+                if data_request.ok and data_request.headers.get('Data-Attached') == 'True':
                     data_format = type_to_format[data_request.headers['Data-Type']]
-                    data = data_request.content.decode() if data_format == Format.TEXT else data_request.content
+                    content = data_request.content
+                    if data_request.headers.get('Data-Encrypted') == 'True':
+                        if cipher is None:
+                            print("Received encrypted clipboard data but no passphrase is set")
+                            return
+                        content = cipher.decrypt(content, data_request.headers['Data-Type'], group)
+                    elif cipher is not None:
+                        # Anything unencrypted could have come from the server or a device outside the group
+                        print("Ignored unencrypted clipboard data because a passphrase is set")
+                        return
+                    data = content.decode() if data_format == Format.TEXT else content
 
                     try:
                         clipboard.OpenClipboard()
@@ -217,6 +294,7 @@ def detect_server_change():
                         clipboard.SetClipboardData(data_format.value, data)
                         clipboard.CloseClipboard()
                         current_data, current_format = get_copied_data()
+                        current_etag = data_request.headers.get('ETag')
                     except Exception as e:
                         print(f"Error updating clipboard: {e}")
                         try:
@@ -252,7 +330,7 @@ def start_server():
 
     if server_thread is not None and server_thread.is_alive():
         try:
-            http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
+            control_http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
         except Exception:
             pass
         server_thread.join(timeout=3)
@@ -262,7 +340,8 @@ def start_server():
 
     # Launch Flask in a background thread
     def _run():
-        run_server(port, connected_devices, server_timestamp)
+        run_server(port, connected_devices, server_timestamp, data_dir=data_dir, persist_history=persist_history,
+                   persist_plaintext=persist_plaintext)
 
     server_thread = Thread(target=_run, daemon=True)
     server_thread.start()
@@ -311,7 +390,7 @@ def close():
     # Clean up server process
     if server_thread is not None and server_thread.is_alive():
         try:
-            http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
+            control_http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
         except Exception:
             pass
         server_thread.join(timeout=3)
@@ -319,7 +398,13 @@ def close():
     # Save preferences
     try:
         with open(preferences_file, 'wb') as save_file:
-            pickle.dump(port, save_file)
+            pickle.dump({
+                'port': port,
+                'group': group,
+                'encryption key': protect_key(cipher.key) if cipher is not None else None,
+                'persist history': persist_history,
+                'persist plaintext': persist_plaintext
+            }, save_file)
     except Exception as e:
         print(f"Error saving preferences: {e}")
 
@@ -344,7 +429,7 @@ def toggle_server():
         # Stop server
         if server_thread is not None and server_thread.is_alive():
             try:
-                http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
+                control_http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
             except Exception as e:
                 print(f"Error stopping server: {e}")
             server_thread.join(timeout=3)
@@ -372,7 +457,7 @@ def edit_port():
         # Stop the server first
         if server_thread is not None and server_thread.is_alive():
             try:
-                http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
+                control_http.post(f'http://127.0.0.1:{port}/shutdown', timeout=2)
             except Exception as e:
                 print(f"Error stopping server: {e}")
             server_thread.join(timeout=3)
@@ -397,6 +482,74 @@ def edit_port():
         port_dialog_open.clear()
 
 
+def edit_group():
+    global group
+    global cipher
+
+    # Prevent multiple dialogs
+    if port_dialog_open.is_set():
+        return
+    port_dialog_open.set()
+    try:
+        group_dialog = GroupEditor(group)
+        new_group = group_dialog.get_group()
+        if new_group is None or new_group.strip() == group:
+            return
+        new_group = new_group.strip()
+
+        # The key is salted with the group, so the new group needs its passphrase before switching to it
+        new_cipher = cipher
+        if cipher is not None:
+            new_passphrase = PassphraseEditor().get_passphrase()
+            if new_passphrase is None:
+                print("Group not changed: enter the new group's passphrase, or leave it empty to turn off encryption")
+                return
+            new_cipher = PayloadCipher.from_passphrase(new_passphrase, new_group) if new_passphrase else None
+            if new_cipher is None:
+                print("Encryption turned off")
+
+        group = new_group
+        cipher = new_cipher
+        print(f"Group changed to: {group or 'Default'}")
+        update_handoff_token()
+        # Re-register with the current server so it moves this device to the new group
+        if server_url:
+            register(urlsplit(server_url).hostname)
+    finally:
+        port_dialog_open.clear()
+
+
+def edit_passphrase():
+    global cipher
+
+    # Prevent multiple dialogs
+    if port_dialog_open.is_set():
+        return
+    port_dialog_open.set()
+    try:
+        passphrase_dialog = PassphraseEditor()
+        new_passphrase = passphrase_dialog.get_passphrase()
+
+        if new_passphrase is not None:
+            cipher = PayloadCipher.from_passphrase(new_passphrase, group) if new_passphrase else None
+            print(f"Encryption turned {'on' if cipher is not None else 'off'}")
+            update_handoff_token()
+    finally:
+        port_dialog_open.clear()
+
+
+def toggle_persist_plaintext():
+    global persist_plaintext
+    persist_plaintext = not persist_plaintext
+    set_persistence(persist_history, persist_plaintext)
+
+
+def toggle_persist_history():
+    global persist_history
+    persist_history = not persist_history
+    set_persistence(persist_history, persist_plaintext)
+
+
 def toggle_dark_icon():
     global use_dark_icon
     use_dark_icon = not use_dark_icon
@@ -412,6 +565,12 @@ def get_menu_items():
     menu_items = (
         MenuItem('Stop Server' if running_server else 'Start Server', lambda _: toggle_server()),
         MenuItem(f'Port: {port}', Menu(MenuItem('Edit', lambda _: Thread(target=edit_port, daemon=True).start()))),
+        MenuItem(f'Group: {group or "Default"}', Menu(MenuItem('Edit', lambda _: Thread(target=edit_group, daemon=True).start()))),
+        MenuItem('Encryption: On' if cipher is not None else 'Encryption: Off', Menu(MenuItem('Set Passphrase', lambda _: Thread(target=edit_passphrase, daemon=True).start()))),
+        MenuItem('Save Clipboard to Disk', Menu(
+            MenuItem('Unencrypted Items: On' if persist_plaintext else 'Unencrypted Items: Off', lambda _: toggle_persist_plaintext()),
+            MenuItem('History: On' if persist_history else 'History: Off', lambda _: toggle_persist_history()),
+        )),
         MenuItem('Start on Login: On' if is_startup_enabled() else 'Start on Login: Off', lambda _: toggle_startup()),
         MenuItem('View Connected Devices', Menu(lambda: (
             MenuItem(f"{name} ({ip})", None) for ip, name in connected_devices.get_devices()
@@ -470,11 +629,26 @@ if __name__ == '__main__':
     preferences_file = os.path.join(data_dir, 'preferences.pickle')
     try:
         with open(preferences_file, 'rb') as preferences:
-            port = pickle.load(preferences)
+            saved_preferences = pickle.load(preferences)
+        # Older versions saved only the port number
+        if isinstance(saved_preferences, int):
+            saved_preferences = {'port': saved_preferences}
+        port = saved_preferences.get('port', 5000)
+        group = saved_preferences.get('group', '')
+        encryption_key = unprotect_key(saved_preferences.get('encryption key'))
+        persist_history = saved_preferences.get('persist history', False)
+        persist_plaintext = saved_preferences.get('persist plaintext', False)
     except FileNotFoundError:
         port = 5000
+        group = ''
+        encryption_key = None
+        persist_history = False
+        persist_plaintext = False
+    cipher = PayloadCipher(encryption_key) if encryption_key else None
+    update_handoff_token()
 
     current_data, current_format = get_copied_data()
+    current_etag = None
 
     format_to_type = {Format.TEXT: 'text', Format.IMAGE: 'image'}
     type_to_format = {v: k for k, v in format_to_type.items()}
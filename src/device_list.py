@@ -2,32 +2,55 @@
 Class to keep track of connected devices
 """
 
+import os
+import json
 import time
 import threading
 
 
 class DeviceList:
-    def __init__(self, timeout=30):
+    def __init__(self, timeout=30, rate_limit=5.0, burst=10):
         self._devices = {}
         self.timeout = timeout
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self._stats = {
+            'accepted': 0,
+            'too large': 0,
+            'rate limited': 0,
+            'coalesced': 0
+        }
         self._lock = threading.Lock()
 
-    def get_devices(self):
+    def get_devices(self, group=None):
         device_list = []
         with self._lock:
             for ip, device in list(self._devices.items()):
                 if time.time() - device['last active'] > self.timeout:
                     del self._devices[ip]
-                else:
+                elif group is None or device['group'] == group:
                     device_list.append((ip, device['name']))
         return device_list
 
-    def add_device(self, ip, name):
+    def get_groups(self):
+        """
+        Returns the groups that still have at least one active device
+        """
+        with self._lock:
+            for ip, device in list(self._devices.items()):
+                if time.time() - device['last active'] > self.timeout:
+                    del self._devices[ip]
+            return {device['group'] for device in self._devices.values()}
+
+    def add_device(self, ip, name, group=''):
         with self._lock:
             self._devices.update({ip: {
                 'name': name,
+                'group': group,
                 'last active': time.time(),
-                'received': False
+                'received': False,
+                'tokens': float(self.burst),
+                'last refill': time.time()
             }})
 
     def clear(self):
@@ -47,3 +70,65 @@ class DeviceList:
         with self._lock:
             if ip in self._devices:
                 self._devices[ip]['received'] = value
+
+    def consume_token(self, ip):
+        """
+        Take one token from the device's bucket. Raises KeyError for unregistered devices
+        """
+        with self._lock:
+            device = self._devices[ip]
+            now = time.time()
+            device['tokens'] = min(self.burst, device['tokens'] + (now - device['last refill']) * self.rate_limit)
+            device['last refill'] = now
+            if device['tokens'] < 1:
+                return False
+            device['tokens'] -= 1
+            return True
+
+    def get_group(self, ip):
+        """
+        Returns the group of a device. Raises KeyError for unregistered devices
+        """
+        with self._lock:
+            return self._devices[ip]['group']
+
+    def count_pending(self, group, exclude=None):
+        with self._lock:
+            return sum(1 for ip, device in self._devices.items()
+                       if ip != exclude and device['group'] == group and not device['received'])
+
+    def record(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['devices'] = len(self._devices)
+        return stats
+
+    def save(self, path):
+        """
+        Writes the registered devices to path so they can be restored after a restart
+        """
+        temp_path = path + '.tmp'
+        with self._lock:
+            registry = {ip: {'name': device['name'], 'group': device['group'], 'last active': device['last active']}
+                        for ip, device in self._devices.items()}
+            with open(temp_path, 'w') as registry_file:
+                json.dump(registry, registry_file)
+            os.replace(temp_path, path)
+
+    def load(self, path):
+        try:
+            with open(path) as registry_file:
+                registry = json.load(registry_file)
+        except (FileNotFoundError, ValueError):
+            return
+        for ip, device in registry.items():
+            # Devices that went quiet before the registry was saved are not restored
+            if time.time() - device.get('last active', 0.0) > self.timeout:
+                continue
+            self.add_device(ip, device['name'], device['group'])
+            with self._lock:
+                self._devices[ip]['last active'] = device['last active']
@@ -0,0 +1,72 @@
+"""
+Class to send HTTP requests for a single role with its own connection pool
+"""
+
+import weakref
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class _CountingAdapter(HTTPAdapter):
+    """
+    Counts requests and how many of them were sent over a connection that was already open
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stats = {'requests': 0, 'connections': 0}
+        self._seen_sockets = weakref.WeakSet()
+        self._stats_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        # Pools keep the same connection object when they reconnect, so the socket identifies a connection
+        sock = getattr(response.raw.connection, 'sock', None)
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            if sock is None or sock not in self._seen_sockets:
+                self.stats['connections'] += 1
+                if sock is not None:
+                    self._seen_sockets.add(sock)
+        return response
+
+    def get_stats(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+
+class HttpClient:
+    def __init__(self, name, pool_connections, pool_maxsize, timeout):
+        """
+        pool_connections is the number of hosts whose connections are kept, and pool_maxsize is the number of
+        connections kept open to each of them
+        """
+        self.name = name
+        self.timeout = timeout
+
+        self._adapter = _CountingAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_stats(self):
+        stats = self._adapter.get_stats()
+        stats['reused'] = stats['requests'] - stats['connections']
+        return stats
+
+    def close(self):
+        self._session.close()
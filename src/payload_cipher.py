@@ -0,0 +1,92 @@
+"""
+Class to encrypt clipboard payloads with a shared group key
+"""
+
+import hmac
+import struct
+import hashlib
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.exceptions import InvalidTag
+
+MAGIC = b'CCE2'
+CHUNK_SIZE = 64 * 1024
+NONCE_PREFIX_SIZE = 8
+TAG_SIZE = 16
+KEY_SALT = b'common-clipboard'
+
+
+class DecryptionError(Exception):
+    pass
+
+
+class PayloadCipher:
+    """
+    ChaCha20-Poly1305 applied to fixed size chunks of the payload.
+
+    The nonce prefix is derived from the plaintext and its context, so equal payloads produce equal ciphertext and
+    the server can still deduplicate by hash. This reveals only whether two payloads are identical. The data type and
+    group are authenticated with every chunk so the server cannot relabel a payload.
+    """
+
+    def __init__(self, key):
+        if len(key) != 32:
+            raise ValueError('Key must be 32 bytes')
+        self.key = key
+        self._aead = ChaCha20Poly1305(key)
+        self._nonce_key = hashlib.sha256(b'nonce' + key).digest()
+
+    @classmethod
+    def from_passphrase(cls, passphrase, group):
+        """
+        Derives the key from a passphrase salted with the group, so the same passphrase gives each group its own key
+        """
+        return cls(hashlib.scrypt(passphrase.encode(), salt=KEY_SALT + group.encode(), n=2 ** 14, r=8, p=1, dklen=32))
+
+    def handoff_token(self):
+        """
+        Returns a token that proves a server shares the group key without revealing it
+        """
+        return hmac.new(self.key, b'handoff', hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def _context(data_type, group):
+        data_type = data_type.encode()
+        return struct.pack('>H', len(data_type)) + data_type + group.encode()
+
+    def encrypt_chunks(self, data, data_type, group):
+        """
+        Yields the encrypted payload piece by piece so it can be streamed without building the whole ciphertext
+        """
+        view = memoryview(data)
+        context = self._context(data_type, group)
+        nonce_mac = hmac.new(self._nonce_key, context, hashlib.sha256)
+        nonce_mac.update(view)
+        prefix = nonce_mac.digest()[:NONCE_PREFIX_SIZE]
+        yield MAGIC + prefix
+        offsets = range(0, max(len(view), 1), CHUNK_SIZE)
+        for index, offset in enumerate(offsets):
+            final = offset + CHUNK_SIZE >= len(view)
+            yield self._aead.encrypt(prefix + struct.pack('>I', index), view[offset:offset + CHUNK_SIZE],
+                                     (b'\x01' if final else b'\x00') + context)
+
+    def encrypt(self, data, data_type, group):
+        return b''.join(self.encrypt_chunks(data, data_type, group))
+
+    def decrypt(self, data, data_type, group):
+        view = memoryview(data)
+        header_size = len(MAGIC) + NONCE_PREFIX_SIZE
+        if len(view) < header_size + TAG_SIZE or view[:len(MAGIC)] != MAGIC:
+            raise DecryptionError('Payload is not encrypted clipboard data')
+        prefix = bytes(view[len(MAGIC):header_size])
+        context = self._context(data_type, group)
+        body = view[header_size:]
+        chunks = []
+        for index, offset in enumerate(range(0, len(body), CHUNK_SIZE + TAG_SIZE)):
+            final = offset + CHUNK_SIZE + TAG_SIZE >= len(body)
+            try:
+                chunks.append(self._aead.decrypt(prefix + struct.pack('>I', index),
+                                                 body[offset:offset + CHUNK_SIZE + TAG_SIZE],
+                                                 (b'\x01' if final else b'\x00') + context))
+            except InvalidTag:
+                raise DecryptionError('Clipboard data could not be decrypted with the group key')
+        return b''.join(chunks)
@@ -23,6 +23,44 @@ def _ask_port(current_port: int):
         except:
             pass
 
+def _ask_group(current_group: str):
+    import tkinter as tk
+    from tkinter import simpledialog
+    root = tk.Tk()
+    root.withdraw()
+    try:
+        root.attributes('-topmost', True)
+        return simpledialog.askstring(
+            "Group Editor",
+            f"Current group: {current_group or 'Default'}\n\nEnter new group (leave empty for default):",
+            parent=root,
+            initialvalue=current_group
+        )
+    finally:
+        try:
+            root.destroy()
+        except:
+            pass
+
+def _ask_passphrase():
+    import tkinter as tk
+    from tkinter import simpledialog
+    root = tk.Tk()
+    root.withdraw()
+    try:
+        root.attributes('-topmost', True)
+        return simpledialog.askstring(
+            "Encryption",
+            "Enter the passphrase shared by your group (leave empty to turn off encryption):",
+            parent=root,
+            show='*'
+        )
+    finally:
+        try:
+            root.destroy()
+        except:
+            pass
+
 def edit_port(current_port=5000):
     """
     Minimal popup dialog to edit the port. Returns int or None.
@@ -40,3 +78,40 @@ class PortEditor:
     
     def get_port(self):
         return self.new_port
+
+
+def edit_group(current_group=''):
+    """
+    Minimal popup dialog to edit the clipboard group. Returns str or None.
+    """
+    try:
+        return _ask_group(current_group)
+    except Exception:
+        return None
+
+
+class GroupEditor:
+    def __init__(self, current_group):
+        self.current_group = current_group
+        self.new_group = edit_group(current_group)
+
+    def get_group(self):
+        return self.new_group
+
+
+def edit_passphrase():
+    """
+    Minimal popup dialog to enter the encryption passphrase. Returns str or None.
+    """
+    try:
+        return _ask_passphrase()
+    except Exception:
+        return None
+
+
+class PassphraseEditor:
+    def __init__(self):
+        self.new_passphrase = edit_passphrase()
+
+    def get_passphrase(self):
+        return self.new_passphrase
@@ -2,13 +2,24 @@
 File to handle server operations
 """
 
+import os
+import hmac
 import time
-from flask import Flask, request, make_response, send_file
+from flask import Flask, request, make_response, send_file, jsonify
 from io import BytesIO
 from device_list import DeviceList
+from channel_list import ChannelList
 
 app = Flask(__name__)
 
+MAX_PAYLOAD_SIZE = 32 * 1024 * 1024
+COALESCE_DELAY = 0.5
+MAX_COALESCE_DELAY = 2.0
+MAX_GROUP_LENGTH = 64
+# Room for the record header around a payload during a state handoff
+MAX_RECORD_OVERHEAD = 4096
+app.config['MAX_CONTENT_LENGTH'] = MAX_PAYLOAD_SIZE + MAX_RECORD_OVERHEAD
+
 
 
 
@@ -22,30 +33,54 @@ def get_timestamp():
 
 @app.route('/register', methods=['POST'])
 def register():
-    device_info = request.get_json()
+    device_info = request.get_json(silent=True)
     try:
-        connected_devices.add_device(request.remote_addr, device_info['name'])
+        assert isinstance(device_info, dict), 'Provided device information is invalid'
+        group = device_info.get('group') or ''
+        assert isinstance(group, str), 'Provided group must be a string'
+        assert len(group) <= MAX_GROUP_LENGTH, 'Provided group is too long'
+        connected_devices.add_device(request.remote_addr, device_info['name'], group)
+        channels.evict(connected_devices.get_groups(), connected_devices.timeout)
+        if registry_file is not None:
+            connected_devices.save(registry_file)
         return '', 204
     except KeyError:
         return 'Provided device information is invalid', 400
+    except AssertionError as e:
+        return str(e), 400
 
 
 @app.route('/clipboard', methods=['GET', 'HEAD'])
 def send_clipboard():
     try:
         connected_devices.update_activity(request.remote_addr)
-        if not connected_devices.get_received(request.remote_addr):
+        group = connected_devices.get_group(request.remote_addr)
+        item = channels.get_item(group)
+        if request.if_none_match.contains(item['hash']):
+            # The device already holds this item, e.g. after reconnecting to a restarted server
+            connected_devices.set_received(request.remote_addr, True)
+            response = make_response('', 304)
+            response.headers['Data-Attached'] = 'False'
+            response.set_etag(item['hash'])
+            return response
+        # Hold back fan-out until a burst of copies settles so only the latest item is sent, and never send the
+        # empty placeholder of a group nobody has copied to yet
+        if not connected_devices.get_received(request.remote_addr) and item['version'] > 0 and \
+                channels.is_settled(item):
             file = BytesIO()
-            file.write(clipboard)
+            file.write(item['data'])
             file.seek(0)
-            response = make_response(send_file(file, mimetype=data_type))
+            response = make_response(send_file(file, mimetype=item['data type']))
             response.headers['Data-Attached'] = 'True'
-            response.headers['Data-Type'] = data_type
+            response.headers['Data-Type'] = item['data type']
+            response.headers['Data-Encrypted'] = str(item['encrypted'])
             if request.method != 'HEAD':
                 connected_devices.set_received(request.remote_addr, True)
         else:
             response = make_response()
             response.headers['Data-Attached'] = 'False'
+        response.headers['Clipboard-Version'] = str(item['version'])
+        response.set_etag(item['hash'])
         response.status_code = 200
         return response
     except KeyError:
@@ -54,45 +89,139 @@ def send_clipboard():
 
 @app.route('/clipboard', methods=['POST'])
 def update_clipboard():
-    global clipboard
-    global data_type
-
     try:
         connected_devices.update_activity(request.remote_addr)
+        group = connected_devices.get_group(request.remote_addr)
         assert 'Data-Type' in request.headers, 'Missing data type header'
-        clipboard = request.get_data()
-        data_type = request.headers['Data-Type']
-        for ip, _ in connected_devices.get_devices():
+        if request.content_length is not None and request.content_length > max_payload_size:
+            return payload_too_large()
+        if not connected_devices.consume_token(request.remote_addr):
+            return rate_limited()
+        # Encrypted payloads are stored and relayed as opaque bytes
+        encrypted = request.headers.get('Data-Encrypted') == 'True'
+        data = request.get_data()
+        # Chunked uploads carry no Content-Length, so check the size once the body is read
+        if len(data) > max_payload_size:
+            return payload_too_large()
+        version, content_hash = channels.set_item(group, data, request.headers['Data-Type'], encrypted)
+        pending = connected_devices.count_pending(group, exclude=request.remote_addr)
+        if pending:
+            connected_devices.record('coalesced', pending)
+        for ip, _ in connected_devices.get_devices(group):
             connected_devices.set_received(ip, ip == request.remote_addr)
-        return '', 204
+        connected_devices.record('accepted')
+        channels.evict(connected_devices.get_groups(), connected_devices.timeout)
+        return '', 204, {'Clipboard-Version': str(version), 'ETag': f'"{content_hash}"'}
     except KeyError:
         return unregistered_error
     except AssertionError as e:
         return str(e), 400
 
 
-def run_server(port, device_list, _unused_timestamp=None):
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify({**connected_devices.get_stats(), **channels.get_stats()}), 200
+
+
+@app.route('/state', methods=['GET'])
+def export_state():
+    # Only the local application hands its state over, so it is not exposed to the network
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return 'State can only be exported locally', 403
+    return channels.export_state(request.args.get('group', '')), 200, {'Content-Type': 'application/octet-stream'}
+
+
+@app.route('/state', methods=['POST'])
+def import_state():
+    try:
+        group = connected_devices.get_group(request.remote_addr)
+        # Only a retiring server that shares this host's group key may hand over that group's item
+        token = request.headers.get('Handoff-Token', '')
+        if handoff_token is None or group != handoff_group or not hmac.compare_digest(token, handoff_token):
+            return 'Handoff is not authorized for this group', 403
+        if not connected_devices.consume_token(request.remote_addr):
+            return rate_limited()
+        imported = channels.import_state(request.get_data(), group)
+        if imported:
+            for ip, _ in connected_devices.get_devices(group):
+                connected_devices.set_received(ip, ip == request.remote_addr)
+        return jsonify({'imported': imported}), 200
+    except KeyError:
+        return unregistered_error
+
+
+def set_persistence(persist_history, persist_plaintext):
+    """
+    Changes which clipboard items the running server writes to disk
+    """
+    channels.set_persistence(persist_history, persist_plaintext)
+
+
+def set_handoff_token(group, token):
+    """
+    Sets the group whose state this server accepts from a retiring server, along with the token proving the sender
+    shares the group key. A token of None turns handoff off
+    """
+    global handoff_group
+    global handoff_token
+
+    handoff_group = group
+    handoff_token = token
+
+
+def rate_limited():
+    connected_devices.record('rate limited')
+    return 'Too many clipboard updates', 429, {'Retry-After': str(max(1, round(1 / connected_devices.rate_limit)))}
+
+
+@app.errorhandler(413)
+def payload_too_large(_error=None):
+    connected_devices.record('too large')
+    return f'Clipboard data exceeds the maximum size of {max_payload_size} bytes', 413
+
+
+def run_server(port, device_list, _unused_timestamp=None, max_payload=MAX_PAYLOAD_SIZE, data_dir=None,
+               persist_history=False, persist_plaintext=False):
     global timestamp
     global connected_devices
+    global registry_file
+    global max_payload_size
 
     # Use local time for timestamp to avoid external dependencies
     timestamp = time.time()
 
     connected_devices = device_list
-
+    max_payload_size = max_payload
+    app.config['MAX_CONTENT_LENGTH'] = max_payload + MAX_RECORD_OVERHEAD
+
+    # Restore the clipboard and device registry saved by a previous run
+    if data_dir is not None:
+        channels.persist_history = persist_history
+        channels.persist_plaintext = persist_plaintext
+        channels.open(os.path.join(data_dir, 'clipboard.log'))
+        registry_file = os.path.join(data_dir, 'devices.json')
+        connected_devices.load(registry_file)
+
+    # The Werkzeug server closes the connection after every response, so clients of this server open a new
+    # connection per request
     app.run(host='0.0.0.0', port=port, threaded=True, use_reloader=False)
 
 
 unregistered_error = 'The requesting device is not registered to the server', 401
-clipboard = b''
-data_type = 'text'
 timestamp = 0.0
+max_payload_size = MAX_PAYLOAD_SIZE
+registry_file = None
+handoff_group = ''
+handoff_token = None
 connected_devices = DeviceList()
+channels = ChannelList(coalesce_delay=COALESCE_DELAY, max_coalesce_delay=MAX_COALESCE_DELAY)
 
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
     """Gracefully stop the Flask development server."""
+    if registry_file is not None:
+        connected_devices.save(registry_file)
     func = request.environ.get('werkzeug.server.shutdown')
     if func is None:
         return 'Not running with the Werkzeug Server', 500
@@ -15,6 +15,7 @@ if __name__ == '__main__':
                     'requests',
                     'time',
                     'win32clipboard',
+                    'win32crypt',
                     'sys',
                     'os',
                     'pickle',
@@ -27,6 +28,7 @@ if __name__ == '__main__':
                     'io',
                     'ntplib',
                     'flask',
+                    'cryptography',
                     'tkinter'
                 ],
                 'excludes': [
@@ -0,0 +1,150 @@
+import os
+import time
+import channel_list
+from channel_list import ChannelList
+
+
+def reopen(path, **options):
+    channels = ChannelList(**options)
+    channels.open(path)
+    return channels
+
+
+def test_log_replays_current_item(tmp_path):
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path)
+    channels.set_item('office', b'first', 'text', encrypted=True)
+    channels.set_item('office', b'second', 'image', encrypted=True)
+    channels.close()
+
+    item = reopen(path).get_item('office')
+    assert (item['data'], item['data type'], item['version'], item['encrypted']) == (b'second', 'image', 2, True)
+
+
+def test_replay_after_torn_write_keeps_complete_records(tmp_path):
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path)
+    channels.set_item('office', b'complete', 'text', encrypted=True)
+    channels.close()
+    intact_size = os.path.getsize(path)
+
+    torn = ChannelList._encode_record('office', b'never finished', 'text', channel_list.FLAG_ENCRYPTED, 2, 0.0)
+    with open(path, 'ab') as log:
+        log.write(torn[:len(torn) // 2])
+
+    channels = reopen(path)
+    assert channels.get_item('office')['data'] == b'complete'
+    assert os.path.getsize(path) == intact_size
+
+    channels.set_item('office', b'after recovery', 'text', encrypted=True)
+    channels.close()
+    assert reopen(path).get_item('office')['data'] == b'after recovery'
+
+
+def test_plaintext_is_not_persisted_by_default(tmp_path):
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path)
+    channels.set_item('office', b'ciphertext', 'text', encrypted=True)
+    channels.set_item('office', b'password', 'text')
+    channels.close()
+
+    with open(path, 'rb') as log:
+        assert b'password' not in log.read()
+    # The older encrypted item must not come back as the current one
+    assert reopen(path).get_item('office')['version'] == 0
+
+    channels = reopen(path, persist_plaintext=True)
+    channels.set_item('home', b'password', 'text')
+    channels.close()
+    assert reopen(path, persist_plaintext=True).get_item('home')['data'] == b'password'
+
+
+def test_compaction_keeps_only_live_items(tmp_path, monkeypatch):
+    monkeypatch.setattr(channel_list, 'COMPACT_MIN_SIZE', 0)
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path)
+    for index in range(20):
+        channels.set_item('office', b'item %d' % index, 'text', encrypted=True)
+    channels.set_item('home', b'home item', 'text', encrypted=True)
+    channels.close()
+
+    with open(path, 'rb') as log:
+        records = list(ChannelList._decode_records(memoryview(log.read())))
+    assert len(records) <= 4
+    restored = reopen(path)
+    assert restored.get_item('office')['data'] == b'item 19'
+    assert restored.get_item('home')['data'] == b'home item'
+
+
+def test_history_is_persisted_only_when_enabled(tmp_path):
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path, persist_history=True)
+    for index in range(3):
+        channels.set_item('office', b'item %d' % index, 'text', encrypted=True)
+    channels.compact()
+    channels.close()
+    assert len(reopen(path, persist_history=True).get_item('office')['history']) == 3
+
+    channels = reopen(path)
+    channels.compact()
+    channels.close()
+    assert len(reopen(path).get_item('office')['history']) == 1
+
+
+def test_evicted_group_is_not_restored(tmp_path):
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path)
+    channels.set_item('office', b'item', 'text', encrypted=True)
+    channels.evict(set(), idle_timeout=-1)
+    channels.close()
+    assert 'office' not in reopen(path).get_groups()
+
+
+def test_import_uses_relative_age_and_local_clock():
+    sender = ChannelList()
+    sender.set_item('office', b'handed over', 'text', encrypted=True)
+    state = sender.export_state('office')
+
+    receiver = ChannelList()
+    assert receiver.import_state(state, 'home') == 0
+    assert receiver.import_state(state, 'office') == 1
+    item = receiver.get_item('office')
+    assert item['data'] == b'handed over'
+    assert abs(item['last update'] - time.time()) < 1
+
+    # An item copied on the receiver after the sender's one is kept
+    time.sleep(0.01)
+    receiver.set_item('office', b'local', 'text', encrypted=True)
+    assert receiver.import_state(sender.export_state('office'), 'office') == 0
+    assert receiver.get_item('office')['data'] == b'local'
+
+
+def test_reopen_in_same_process_keeps_live_channels(tmp_path):
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path)
+    channels.set_item('', b'copied text', 'text')
+    channels.set_item('office', b'ciphertext', 'text', encrypted=True)
+
+    channels.open(path)
+    item = channels.get_item('')
+    assert (item['data'], item['version']) == (b'copied text', 1)
+    channels.close()
+
+    restored = reopen(path)
+    assert restored.get_item('office')['data'] == b'ciphertext'
+    assert restored.get_item('')['version'] == 0
+
+
+def test_changing_persistence_rewrites_log(tmp_path):
+    path = str(tmp_path / 'clipboard.log')
+    channels = reopen(path)
+    channels.set_item('', b'copied text', 'text')
+    channels.set_persistence(persist_history=False, persist_plaintext=True)
+    channels.close()
+    assert reopen(path).get_item('')['data'] == b'copied text'
+
+    channels.open(path)
+    channels.set_persistence(persist_history=False, persist_plaintext=False)
+    channels.close()
+    with open(path, 'rb') as log:
+        assert b'copied text' not in log.read()
@@ -0,0 +1,22 @@
+import json
+import time
+from device_list import DeviceList
+
+
+def test_load_skips_expired_devices_and_keeps_activity(tmp_path):
+    path = str(tmp_path / 'devices.json')
+    last_active = time.time() - 10
+    with open(path, 'w') as registry_file:
+        json.dump({
+            '10.0.0.2': {'name': 'recent', 'group': 'office', 'last active': last_active},
+            '10.0.0.3': {'name': 'stale', 'group': 'office', 'last active': time.time() - 3600}
+        }, registry_file)
+
+    devices = DeviceList(timeout=30)
+    devices.load(path)
+    assert devices.get_devices() == [('10.0.0.2', 'recent')]
+    assert devices.count_pending('office') == 1
+
+    devices.save(path)
+    with open(path) as registry_file:
+        assert json.load(registry_file)['10.0.0.2']['last active'] == last_active
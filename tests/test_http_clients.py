@@ -0,0 +1,42 @@
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_clients import HttpClient
+
+
+def make_handler(keep_alive):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            if not keep_alive:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'ok')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture(params=[True, False], ids=['keep-alive', 'close'])
+def server_url(request):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(request.param))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/', request.param
+    server.shutdown()
+    server.server_close()
+
+
+def test_reuse_is_counted_per_connection(server_url):
+    url, keep_alive = server_url
+    client = HttpClient('Sync', pool_connections=1, pool_maxsize=2, timeout=2)
+    for _ in range(4):
+        assert client.get(url).text == 'ok'
+
+    stats = client.get_stats()
+    assert stats == ({'requests': 4, 'connections': 1, 'reused': 3} if keep_alive else
+                     {'requests': 4, 'connections': 4, 'reused': 0})
@@ -0,0 +1,59 @@
+import os
+import pytest
+from payload_cipher import PayloadCipher, DecryptionError, MAGIC, CHUNK_SIZE, NONCE_PREFIX_SIZE, TAG_SIZE
+
+HEADER_SIZE = len(MAGIC) + NONCE_PREFIX_SIZE
+SEALED_CHUNK_SIZE = CHUNK_SIZE + TAG_SIZE
+
+
+@pytest.fixture
+def cipher():
+    return PayloadCipher(bytes(range(32)))
+
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE])
+def test_round_trip_at_chunk_boundaries(cipher, size):
+    data = os.urandom(size)
+    encrypted = cipher.encrypt(data, 'image', 'office')
+    assert cipher.decrypt(encrypted, 'image', 'office') == data
+    assert b''.join(cipher.encrypt_chunks(data, 'image', 'office')) == encrypted
+
+
+def test_equal_payloads_give_equal_ciphertext(cipher):
+    assert cipher.encrypt(b'secret', 'text', '') == cipher.encrypt(b'secret', 'text', '')
+    assert cipher.encrypt(b'secret', 'text', '') != cipher.encrypt(b'secret', 'image', '')
+
+
+def test_truncation_is_rejected(cipher):
+    encrypted = cipher.encrypt(os.urandom(3 * CHUNK_SIZE), 'image', '')
+    with pytest.raises(DecryptionError):
+        cipher.decrypt(encrypted[:-SEALED_CHUNK_SIZE], 'image', '')
+    with pytest.raises(DecryptionError):
+        cipher.decrypt(encrypted[:-1], 'image', '')
+
+
+def test_reordering_is_rejected(cipher):
+    encrypted = cipher.encrypt(os.urandom(3 * CHUNK_SIZE), 'image', '')
+    first = encrypted[HEADER_SIZE:HEADER_SIZE + SEALED_CHUNK_SIZE]
+    second = encrypted[HEADER_SIZE + SEALED_CHUNK_SIZE:HEADER_SIZE + 2 * SEALED_CHUNK_SIZE]
+    reordered = encrypted[:HEADER_SIZE] + second + first + encrypted[HEADER_SIZE + 2 * SEALED_CHUNK_SIZE:]
+    with pytest.raises(DecryptionError):
+        cipher.decrypt(reordered, 'image', '')
+
+
+def test_data_type_and_group_are_authenticated(cipher):
+    encrypted = cipher.encrypt(b'secret', 'text', 'office')
+    with pytest.raises(DecryptionError):
+        cipher.decrypt(encrypted, 'image', 'office')
+    with pytest.raises(DecryptionError):
+        cipher.decrypt(encrypted, 'text', 'home')
+
+
+def test_passphrase_key_is_salted_with_group():
+    assert PayloadCipher.from_passphrase('hunter2', 'office').key != PayloadCipher.from_passphrase('hunter2', 'home').key
+    assert PayloadCipher.from_passphrase('hunter2', 'office').key == PayloadCipher.from_passphrase('hunter2', 'office').key
+
+
+def test_plaintext_is_rejected(cipher):
+    with pytest.raises(DecryptionError):
+        cipher.decrypt(b'not encrypted at all, just text', 'text', '')
@@ -0,0 +1,135 @@
+import io
+import time
+import pytest
+import server
+from channel_list import ChannelList
+from device_list import DeviceList
+
+COPIER = {'REMOTE_ADDR': '10.0.0.1'}
+RETIRING = {'REMOTE_ADDR': '10.0.0.2'}
+OTHER = {'REMOTE_ADDR': '10.0.0.3'}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server, 'connected_devices', DeviceList())
+    monkeypatch.setattr(server, 'channels', ChannelList())
+    server.set_handoff_token('office', 'token')
+    yield server.app.test_client()
+    server.set_handoff_token('', None)
+
+
+def handed_over_state():
+    sender = ChannelList()
+    sender.set_item('office', b'handed over', 'text', encrypted=True)
+    return sender.export_state('office')
+
+
+def test_register_rejects_non_object_body(client):
+    assert client.post('/register', json=['name'], environ_base=RETIRING).status_code == 400
+    assert client.post('/register', data='name', environ_base=RETIRING).status_code == 400
+
+
+def test_register_validates_group(client):
+    assert client.post('/register', json={'name': 'device', 'group': 7}, environ_base=RETIRING).status_code == 400
+    assert client.post('/register', json={'name': 'device', 'group': None}, environ_base=RETIRING).status_code == 204
+    assert server.connected_devices.get_group(RETIRING['REMOTE_ADDR']) == ''
+
+
+def test_handoff_requires_registered_caller(client):
+    response = client.post('/state', data=handed_over_state(), headers={'Handoff-Token': 'token'},
+                           environ_base=RETIRING)
+    assert response.status_code == 401
+
+
+def test_handoff_requires_token_for_served_group(client):
+    client.post('/register', json={'name': 'retiring', 'group': 'office'}, environ_base=RETIRING)
+    client.post('/register', json={'name': 'other', 'group': 'home'}, environ_base=OTHER)
+
+    assert client.post('/state', data=handed_over_state(), headers={'Handoff-Token': 'wrong'},
+                       environ_base=RETIRING).status_code == 403
+    assert client.post('/state', data=handed_over_state(), headers={'Handoff-Token': 'token'},
+                       environ_base=OTHER).status_code == 403
+    assert server.channels.get_item('office')['version'] == 0
+
+    response = client.post('/state', data=handed_over_state(), headers={'Handoff-Token': 'token'},
+                           environ_base=RETIRING)
+    assert response.json == {'imported': 1}
+    assert server.channels.get_item('office')['data'] == b'handed over'
+
+
+def test_state_is_only_exported_locally(client):
+    assert client.get('/state', environ_base=RETIRING).status_code == 403
+    assert client.get('/state', environ_base={'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
+
+
+def register(client, environ, group='office'):
+    client.post('/register', json={'name': environ['REMOTE_ADDR'], 'group': group}, environ_base=environ)
+
+
+def copy(client, data, environ=COPIER):
+    return client.post('/clipboard', data=data, headers={'Data-Type': 'text'}, environ_base=environ)
+
+
+def test_oversized_payload_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(server, 'max_payload_size', 8)
+    register(client, COPIER)
+
+    assert copy(client, b'x' * 9).status_code == 413
+    # Chunked uploads carry no Content-Length and are checked once read
+    response = client.post('/clipboard', input_stream=io.BytesIO(b'x' * 9), headers={'Data-Type': 'text'},
+                           environ_base=COPIER, environ_overrides={'wsgi.input_terminated': True})
+    assert response.status_code == 413
+    assert copy(client, b'x' * 8).status_code == 204
+    assert client.get('/stats').json['too large'] == 2
+
+
+def test_empty_bucket_is_rate_limited(client):
+    server.connected_devices.rate_limit = 0.01
+    register(client, COPIER)
+    responses = [copy(client, b'%d' % index) for index in range(server.connected_devices.burst + 1)]
+
+    assert [response.status_code for response in responses[:-1]] == [204] * server.connected_devices.burst
+    assert responses[-1].status_code == 429
+    assert int(responses[-1].headers['Retry-After']) >= 1
+    assert client.get('/stats').json['rate limited'] == 1
+
+
+def test_burst_is_coalesced_with_bounded_hold_back(client, monkeypatch):
+    monkeypatch.setattr(server, 'channels', ChannelList(coalesce_delay=0.2, max_coalesce_delay=0.5))
+    register(client, COPIER)
+    register(client, RETIRING)
+
+    # An isolated copy is sent at once
+    copy(client, b'first')
+    assert client.get('/clipboard', environ_base=RETIRING).data == b'first'
+
+    # Later copies in the burst are held until it settles
+    copy(client, b'second')
+    copy(client, b'third')
+    assert client.get('/clipboard', environ_base=RETIRING).headers['Data-Attached'] == 'False'
+    time.sleep(0.25)
+    assert client.get('/clipboard', environ_base=RETIRING).data == b'third'
+
+    # A device copying in a loop cannot hold fan-out back for longer than the maximum delay
+    received = []
+    start = time.time()
+    while time.time() - start < 1.0:
+        copy(client, b'loop %f' % time.time())
+        response = client.get('/clipboard', environ_base=RETIRING)
+        if response.headers['Data-Attached'] == 'True':
+            received.append(response.data)
+        time.sleep(0.1)
+    assert received
+    assert client.get('/stats').json['coalesced'] >= 1
+
+
+def test_stats_report_devices_and_channels(client):
+    register(client, COPIER)
+    register(client, RETIRING, group='home')
+    copy(client, b'stats')
+
+    stats = client.get('/stats').json
+    assert stats['accepted'] == 1
+    assert stats['devices'] == 2
+    assert stats['channels'] == 1